@@ -272,7 +272,7 @@ def find_assemblies(neural_data, method='ica', nullhyp='mp', n_shuffles=1000,
         (n/a if nullhyp is NOT 'mp')
 
     """
-    spiking, _, bool_arr = get_transient_timestamps(neural_data)
+    spiking, _, bool_arr, _ = get_transient_timestamps(neural_data)
 
     patterns, significance, z_data = \
         runPatterns(bool_arr, method=method, nullhyp=nullhyp,
@@ -349,10 +349,10 @@ def lapsed_activation(template_data, lapsed_data,  method='ica',
         template_data = template_data[neurons]
 
     # Get event timestamps.
-    spiking, rate, bool_arr = get_transient_timestamps(template_data)
+    spiking, rate, bool_arr, _ = get_transient_timestamps(template_data)
     spiking, rate, bool_arr = [spiking], [rate], [bool_arr]
     for session in lapsed_data:
-        temp_s, temp_r, temp_bool = get_transient_timestamps(session)
+        temp_s, temp_r, temp_bool, _ = get_transient_timestamps(session)
         spiking.append(temp_s)
         rate.append(temp_r)
         bool_arr.append(temp_bool)
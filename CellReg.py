@@ -6,6 +6,8 @@ import numpy as np
 import glob
 import h5py
 import pickle
+import gc
+from joblib import Parallel, delayed
 
 class SpatialFootprints():
     def __init__(self, mouse_path):
@@ -27,7 +29,7 @@ class SpatialFootprints():
         self.session_paths = [folder.parent for folder in Path(self.mouse_path).rglob('minian')]
         self.session_numbers = [folder.parts[-2] for folder in self.session_paths]
 
-    def make_mat(self, save_path=None):
+    def make_mat(self, save_path=None, format='mat', n_jobs=4):
         """
         Makes spatial footprints .mat for CellReg Matlab package.
 
@@ -35,30 +37,65 @@ class SpatialFootprints():
         ---
         save_path: str, path to save .mat file. Defaults to a folder called
             SpatialFootprints inside the session_id folder.
+        format: str, 'mat' or 'npy'. 'npy' writes the footprints with
+            np.save instead, which is faster but not readable by CellReg.
+        n_jobs: int, maximum number of sessions to convert at once. Each
+            one holds a full footprints array in memory.
         """
         if save_path is None:
             save_path = os.path.join(self.mouse_path, 'SpatialFootprints')
 
         cellreg_path = os.path.join(save_path, 'CellRegResults')
-        os.mkdir(save_path)
-        os.mkdir(cellreg_path)
+        os.makedirs(save_path, exist_ok=True)
+        os.makedirs(cellreg_path, exist_ok=True)
 
-        for session, session_number in zip(self.session_paths,
-                                           self.session_numbers):
-            #File name.
-            fname = os.path.join(save_path, session_number+'.mat')
+        # Sessions are independent and mostly I/O-bound so use threads.
+        n_jobs = max(1, min(len(self.session_paths), n_jobs))
+        Parallel(n_jobs=n_jobs, backend='threading')(
+            delayed(_convert_session)(session, session_number, save_path,
+                                      format=format)
+            for session, session_number in zip(self.session_paths,
+                                               self.session_numbers))
 
-            # Load data.
-            data = open_minian(session)
 
-            # Reshape matrix. CellReg reads (neuron, x, y) arrays.
-            footprints = np.asarray(data.A)
-            footprints = np.rollaxis(footprints, 2)
+def _convert_session(session, session_number, save_path, format='mat'):
+    """
+    Writes one session's spatial footprints to a .mat file.
 
-            # Save.
-            savemat(fname,
-                    {'footprints': footprints})
-            print(f'Saved {fname}')
+    :parameters
+    ---
+    session: str, session_id folder containing the minian folder.
+    session_number: str, used as the file name.
+    save_path: str, folder to save the .mat file in.
+    format: str, 'mat' or 'npy'.
+    """
+    #File name.
+    fname = os.path.join(save_path, session_number+'.mat')
+
+    # Load data.
+    data = open_minian(session)
+
+    # Rechunk into a single chunk so each zarr chunk is read and decoded
+    # only once, then compute. make_mat already runs sessions in parallel
+    # so don't start another thread pool per session.
+    footprints = data.A.chunk({dim: -1 for dim in data.A.dims})
+    footprints = footprints.data.compute(scheduler='single-threaded')
+
+    # Reshape matrix. CellReg reads (neuron, x, y) arrays.
+    footprints = np.moveaxis(footprints, 2, 0)
+
+    # Save.
+    if format == 'mat':
+        savemat(fname,
+                {'footprints': footprints},
+                format='5', do_compression=False, oned_as='column',
+                appendmat=False)
+    elif format == 'npy':
+        fname = fname.replace('.mat', '.npy')
+        np.save(fname, footprints)
+    else:
+        raise NotImplementedError("format {} not supported".format(format))
+    print(f'Saved {fname}')
 
 
 class CellRegObj:
@@ -77,6 +114,12 @@ class CellRegObj:
             self.map = self.load_cellreg_results()
         except:
             self.data, self.file  = self.read_cellreg_output()
+
+            # Dereference the per-session datasets once up front.
+            self._fp_datasets = self.resolve_references(
+                'spatial_footprints_corrected')
+            self._centroid_datasets = self.resolve_references(
+                'centroid_locations_corrected')
             self.compile_cellreg_data()
 
     def load_cellreg_results(self, mode='map'):
@@ -86,11 +129,21 @@ class CellRegObj:
         """
         # Get file name based on mode.
         file_dict = {'map': 'CellRegResults.pkl',
-                     'footprints': 'CellRegFootprints.pkl',
+                     'footprints': 'CellRegFootprints.npz',
                      'centroids': 'CellRegCentroids.pkl',
                      }
         fname = os.path.join(self.path, file_dict[mode])
 
+        # Footprints are saved as an npz with one array per session.
+        # Results folders from before that still hold a pkl.
+        if mode == 'footprints' and not os.path.isfile(fname):
+            fname = fname.replace('.npz', '.pkl')
+        elif mode == 'footprints':
+            with np.load(fname) as file:
+                data = [file[session] for session in file.files]
+
+            return data
+
         # Open pkl file.
         with open(fname, 'rb') as file:
             data = pickle.load(file)
@@ -104,19 +157,44 @@ class CellRegObj:
         """
         cellreg_file = glob.glob(os.path.join(self.path,'cellRegistered*.mat'))
         assert len(cellreg_file) > 0, "No registration .mat detected."
-        assert len(cellreg_file) is 1, "Multiple cell registration files!"
+        assert len(cellreg_file) == 1, "Multiple cell registration files!"
         cellreg_file = cellreg_file[0]
 
-        # Load it.
-        file = h5py.File(cellreg_file)
+        # Load it. Read-only, with a chunk cache big enough to hold a
+        # whole session's footprints (the default is 1 MiB). The chunk
+        # cache options need h5py >= 2.9.
+        if h5py.version.version_tuple[:2] >= (2, 9):
+            cache = {'rdcc_nbytes': 256*1024*1024,
+                     'rdcc_nslots': 1000003,
+                     'rdcc_w0': 0.75}
+        else:
+            cache = {}
+        file = h5py.File(cellreg_file, 'r', **cache)
         data = file['cell_registered_struct']
 
         return data, file
 
+    def resolve_references(self, name):
+        """
+        Opens the HDF5 datasets referenced by a cell array in the
+        cell_registered_struct (one per session).
+
+        :parameter
+        ---
+        name: str, field of cell_registered_struct holding the references.
+
+        :return
+        ---
+        datasets: list of h5py Datasets.
+        """
+        references = self.data[name][()][0]
+
+        return [self.file[ref] for ref in references]
+
     def process_registration_map(self):
         # Get the cell_to_index_map. Reading the file transposes the
         # matrix. Transpose it back.
-        cell_to_index_map = self.data['cell_to_index_map'].value.T
+        cell_to_index_map = self.data['cell_to_index_map'][()].T
 
         # Matlab indexes starting from 1. Correct this.
         match_map = cell_to_index_map - 1
@@ -125,23 +203,25 @@ class CellRegObj:
 
     def process_spatial_footprints(self):
         # Get the spatial footprints after translations.
-        footprints_reference = self.data['spatial_footprints_corrected'].value[0]
-
         footprints = []
-        for idx in footprints_reference:
-            # Float 32 takes less memory.
-            session_footprints = np.float32(np.transpose(self.file[idx].value, (2, 0, 1)))
+        for dset in self._fp_datasets:
+            # Float 32 takes less memory. Read straight into a float32
+            # buffer rather than converting a float64 copy.
+            if dset.dtype == np.float32:
+                buf = dset[()]
+            else:
+                buf = np.empty(dset.shape, dtype=np.float32)
+                dset.read_direct(buf)
+            session_footprints = np.ascontiguousarray(buf.transpose(2, 0, 1))
             footprints.append(session_footprints)
 
         return footprints
 
     def process_centroids(self):
         # Also get centroid positions after translations.
-        centroids_reference = self.data['centroid_locations_corrected'].value[0]
-
         centroids = []
-        for idx in centroids_reference:
-            session_centroids = self.file[idx].value.T
+        for dset in self._centroid_datasets:
+            session_centroids = np.ascontiguousarray(dset[()].T)
             centroids.append(session_centroids)
 
         return centroids
@@ -156,16 +236,27 @@ class CellRegObj:
         filename =\
             os.path.join(self.path,'CellRegResults.pkl')
         filename_footprints = \
-            os.path.join(self.path,'CellRegFootprints.pkl')
+            os.path.join(self.path,'CellRegFootprints.npz')
         filename_centroids = \
             os.path.join(self.path, 'CellRegCentroids.pkl')
 
-        with open(filename, 'wb') as output:
-            pickle.dump(match_map, output, protocol=4)
-        with open(filename_footprints, 'wb') as output:
-            pickle.dump(footprints, output, protocol=4)
-        with open(filename_centroids, 'wb') as output:
-            pickle.dump(centroids, output, protocol=4)
+        # Use the newest protocol (5 on Python 3.8+) so large arrays are
+        # pickled without an extra copy. The garbage collector only slows
+        # the dumps down here.
+        gc.disable()
+        try:
+            with open(filename, 'wb') as output:
+                pickle.dump(match_map, output,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            with open(filename_centroids, 'wb') as output:
+                pickle.dump(centroids, output,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            gc.enable()
+
+        # Footprints are by far the largest output. Save them compressed,
+        # one array per session.
+        np.savez_compressed(filename_footprints, *footprints)
 
 def trim_map(map, cols, detected='everyday'):
     """
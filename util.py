@@ -1,11 +1,20 @@
 import os
 import xarray as xr
+import zarr
 from natsort import natsorted
 import glob
 import pandas as pd
 import numpy as np
 import cv2
 import itertools
+import shutil
+import subprocess
+import tempfile
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
 
 def open_minian(dpath, fname='minian', backend='zarr', chunks=None):
     """
@@ -18,7 +27,7 @@ def open_minian(dpath, fname='minian', backend='zarr', chunks=None):
     backend: str, 'zarr' or 'netcdf'. 'netcdf' seems outdated.
     chunks: ??
     """
-    if backend is 'netcdf':
+    if backend == 'netcdf':
         fname = fname + '.nc'
         mpath = os.path.join(dpath, fname)
         with xr.open_dataset(mpath) as ds:
@@ -28,13 +37,17 @@ def open_minian(dpath, fname='minian', backend='zarr', chunks=None):
 
         return ds
 
-    elif backend is 'zarr':
+    elif backend == 'zarr':
         mpath = os.path.join(dpath, fname)
-        dslist = [xr.open_zarr(os.path.join(mpath, d))
+        # Variables whose metadata was consolidated (see consolidate())
+        # are opened from a single .zmetadata read.
+        dslist = [xr.open_zarr(os.path.join(mpath, d),
+                               consolidated=os.path.isfile(
+                                   os.path.join(mpath, d, '.zmetadata')))
                   for d in os.listdir(mpath)
                   if os.path.isdir(os.path.join(mpath, d))]
         ds = xr.merge(dslist)
-        if chunks is 'auto':
+        if chunks == 'auto':
             chunks = dict([(d, 'auto') for d in ds.dims])
 
         return ds.chunk(chunks)
@@ -43,6 +56,23 @@ def open_minian(dpath, fname='minian', backend='zarr', chunks=None):
         raise NotImplementedError("backend {} not supported".format(backend))
 
 
+def consolidate(dpath, fname='minian'):
+    """
+    Consolidates the zarr metadata of minian outputs so that
+    open_minian() only needs to read one .zmetadata file per variable.
+    Only needs to be run once per minian folder.
+
+    Parameters
+    ---
+    dpath: str, path to folder containing the minian outputs folder.
+    fname: str, name of the minian output folder.
+    """
+    mpath = os.path.join(dpath, fname)
+    for d in os.listdir(mpath):
+        if os.path.isdir(os.path.join(mpath, d)):
+            zarr.consolidate_metadata(os.path.join(mpath, d))
+
+
 def concat_avis(path, pattern='behavCam*.avi',
                 fname='Merged.avi', fps=30, isColor=True):
     """
@@ -62,15 +92,39 @@ def concat_avis(path, pattern='behavCam*.avi',
     """
     # Get all files.
     files = natsorted(glob.glob(os.path.join(path, pattern)))
+    final_clip_name = os.path.join(path, fname)
+
+    # If we don't need to convert to grayscale or change the frame rate
+    # and all clips share a codec and frame size, have ffmpeg copy the
+    # packets over without decoding them.
+    props = [_video_properties(file) for file in files]
+    fourccs, sizes, rates = zip(*props)
+    stream_copy = isColor and shutil.which('ffmpeg') is not None \
+                  and len(set(fourccs)) == 1 and len(set(sizes)) == 1 \
+                  and all(abs(rate - fps) < 1e-3 for rate in rates)
+
+    if stream_copy:
+        with tempfile.NamedTemporaryFile('w', suffix='.txt',
+                                         delete=False) as concat_txt:
+            for file in files:
+                file = os.path.abspath(file).replace("'", "'\\''")
+                concat_txt.write(f"file '{file}'\n")
+
+        try:
+            print(f'Writing {final_clip_name}')
+            subprocess.run(['ffmpeg', '-y', '-f', 'concat', '-safe', '0',
+                            '-i', concat_txt.name, '-c', 'copy',
+                            final_clip_name], check=True)
+        finally:
+            os.remove(concat_txt.name)
+
+        return final_clip_name
 
     # Get width and height.
-    cap = cv2.VideoCapture(files[0])
-    size = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), \
-           int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    size = sizes[0]
 
     # Define writer.
     fourcc = 0
-    final_clip_name = os.path.join(path, fname)
     writer = cv2.VideoWriter(final_clip_name, fourcc,
                              fps, size, isColor=isColor)
 
@@ -100,6 +154,30 @@ def concat_avis(path, pattern='behavCam*.avi',
     return final_clip_name
 
 
+def _video_properties(file):
+    """
+    Gets the codec, frame size and frame rate of a video.
+
+    Parameters
+    ---
+    file: str, path to video.
+
+    Return
+    ---
+    fourcc: int, codec FOURCC code.
+    size: tuple, (width, height).
+    fps: float, frame rate.
+    """
+    cap = cv2.VideoCapture(file)
+    fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+    size = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), \
+           int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+
+    return fourcc, size, fps
+
+
 def read_eztrack(csv_fname, cm_per_pixel=1):
     """
     Reads ezTrack outputs.
@@ -145,22 +223,29 @@ def synchronize_time_series(position, neural, behav_fps=30, neural_fps=15):
     neural_nframes = neural.shape[1]
     behav_nframes = len(position['frame'])
 
-    # Create time vectors.
-    neural_t = np.arange(0, neural_nframes/neural_fps, 1/neural_fps)
-    behav_t = np.arange(0, behav_nframes/behav_fps, 1/behav_fps)
+    # Create time vectors. Integer arange avoids float step round-off
+    # so neural_t has exactly neural_nframes samples.
+    neural_t = np.arange(neural_nframes) / neural_fps
+    behav_t = np.arange(behav_nframes) / behav_fps
+
+    # Interpolate. Keep x and y together in one (t, 2) array so the
+    # arithmetic below runs over a single buffer.
+    xy = np.empty((neural_nframes, 2), dtype=np.float32)
+    xy[:, 0] = np.interp(neural_t, behav_t, position['x'])
+    xy[:, 1] = np.interp(neural_t, behav_t, position['y'])
 
-    # Interpolate.
-    position['x'] = np.interp(neural_t, behav_t, position['x'])
-    position['y'] = np.interp(neural_t, behav_t, position['y'])
-    position['frame'] = np.interp(neural_t, behav_t, position['frame'])
+    # Frames are integers, just take the nearest behavior frame.
+    behav_idx = np.round(neural_t * behav_fps).astype(np.int64)
+    behav_idx = behav_idx.clip(0, behav_nframes - 1)
+    position['frame'] = np.asarray(position['frame'])[behav_idx]
 
     # Normalize.
-    position['x'] = position['x'] - min(position['x'])
-    position['y'] = position['y'] - min(position['y'])
+    xy -= xy.min(axis=0)
+    position['x'], position['y'] = xy[:, 0], xy[:, 1]
 
     # Compute distance at each consecutive point.
-    pos_diff = np.diff(position['x']), np.diff(position['y'])
-    position['distance'] = np.hypot(pos_diff[0], pos_diff[1])
+    pos_diff = xy[1:] - xy[:-1]
+    position['distance'] = np.hypot(pos_diff[:, 0], pos_diff[:, 1])
 
     # Compute velocity by dividing by 1/fps.
     position['velocity'] = \
@@ -191,6 +276,12 @@ def get_transient_timestamps(neural_data, std_thresh=3):
     event_mags: list of length neuron
         Event magnitudes.
 
+    bool_arr: (neuron, time) boolean array
+        True where activity exceeds threshold.
+
+    counts: (neuron,) array
+        Number of events for each neuron.
+
     """
     # Compute thresholds for each neuron.
     stds = np.std(neural_data, axis=1)
@@ -198,15 +289,95 @@ def get_transient_timestamps(neural_data, std_thresh=3):
     thresh = means + std_thresh*stds
 
     # Get event times and magnitudes.
-    bool_arr = neural_data > np.tile(thresh,[neural_data.shape[1], 1]).T
+    bool_arr, indptr, event_idx, mags = extract_events(neural_data, thresh)
+    event_times = np.split(event_idx, indptr[1:-1])
+    event_mags = np.split(mags, indptr[1:-1])
+
+    # Event counts fall out of the row pointers for free.
+    counts = np.diff(indptr)
 
-    event_times = [np.where(neuron > t)[0] for neuron, t
-                   in zip(neural_data, thresh)]
+    return event_times, event_mags, bool_arr, counts
 
-    event_mags = [neuron[neuron > t] for neuron, t
-                  in zip(neural_data, thresh)]
 
-    return event_times, event_mags, bool_arr
+def extract_events(neural_data, thresh):
+    """
+    Finds all samples that exceed a per-neuron threshold. Events are
+    returned in compressed sparse row form, so neuron i's events are
+    event_idx[indptr[i]:indptr[i+1]].
+
+    numba is an optional dependency (listed in environment.yml). If it is
+    installed, a parallel numba kernel does the work, otherwise this falls
+    back to numpy. Both give the same results.
+
+    :parameters
+    ---
+    neural_data: (neuron, time) array
+        Neural time series, (e.g., C or S).
+
+    thresh: (neuron,) array
+        Threshold for each neuron.
+
+    :returns
+    ---
+    bool_arr: (neuron, time) boolean array
+        True where activity exceeds threshold.
+
+    indptr: (neuron+1,) array
+        Start and end of each neuron's events in event_idx and mags.
+
+    event_idx: array
+        Timestamps of all events.
+
+    mags: array
+        Event magnitudes.
+    """
+    neural_data = np.asarray(neural_data)
+    thresh = np.asarray(thresh, dtype=np.float64)
+
+    if njit is not None:
+        return _extract_events_jit(np.ascontiguousarray(neural_data),
+                                   thresh)
+
+    # Broadcast the thresholds and only do the comparison once.
+    bool_arr = neural_data > thresh[:, None]
+    rows, event_idx = np.nonzero(bool_arr)
+    indptr = np.zeros(neural_data.shape[0] + 1, dtype=np.int64)
+    np.cumsum(bool_arr.sum(axis=1), out=indptr[1:])
+
+    return bool_arr, indptr, event_idx, neural_data[rows, event_idx]
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _extract_events_jit(neural_data, thresh):
+        n_neurons, n_samples = neural_data.shape
+
+        # First pass: threshold and count events per neuron.
+        bool_arr = np.empty((n_neurons, n_samples), dtype=np.bool_)
+        counts = np.zeros(n_neurons, dtype=np.int64)
+        for i in prange(n_neurons):
+            count = 0
+            for t in range(n_samples):
+                above = neural_data[i, t] > thresh[i]
+                bool_arr[i, t] = above
+                count += above
+            counts[i] = count
+
+        indptr = np.zeros(n_neurons + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(counts)
+
+        # Second pass: fill in each neuron's slice.
+        event_idx = np.empty(indptr[-1], dtype=np.int64)
+        mags = np.empty(indptr[-1], dtype=neural_data.dtype)
+        for i in prange(n_neurons):
+            k = indptr[i]
+            for t in range(n_samples):
+                if bool_arr[i, t]:
+                    event_idx[k] = t
+                    mags[k] = neural_data[i, t]
+                    k += 1
+
+        return bool_arr, indptr, event_idx, mags
 
 
 def distinct_colors(n):
@@ -231,27 +402,45 @@ def distinct_colors(n):
     points = [0, max_]
     points.extend(MidSort(p))
 
-    # Not efficient!!! Iterate over higher valued 'ticks' first (the points
-    #   at the front of the list) to vary all colors and not focus on one channel.
-    colors = ["#%02X%02X%02X" % (points[0], points[0], points[0])]
-    r = 0
-    total = 1
-    while total < n and r < len(points):
-        r += 1
-        for c0 in range(r):
-            for c1 in range(r):
-                for c2 in range(r):
-                    if total >= n:
-                        break
-                    c = "#%02X%02X%02X" % (points[c0], points[c1], points[c2])
-                    if c not in colors and c != '#FFFFFF':
-                        colors.append(c)
-                        total += 1
+    # Iterate over higher valued 'ticks' first (the points at the front of
+    #   the list) to vary all colors and not focus on one channel. Build
+    #   every (r, g, b) combination of ticks at once, ordered by the
+    #   highest tick index used, then lexicographically.
+    points = np.asarray(points)
+    n_points = len(points)
+    idx = np.indices((n_points, n_points, n_points)).reshape(3, -1).T
+    idx = idx[np.argsort(idx.max(axis=1), kind='stable')]
+    rgb = points[idx]
+
+    # Drop white and any repeated colors, keeping the first occurrence.
+    rgb = rgb[~(rgb == max_).all(axis=1)]
+    _, first = np.unique(rgb, axis=0, return_index=True)
+    rgb = rgb[np.sort(first)][:n]
+
+    colors = ["#%02X%02X%02X" % tuple(c) for c in rgb]
 
     return colors
 
 
 def ordered_unique(sequence):
+    """
+    Unique elements of sequence, in order of first appearance.
+
+    :parameters
+    ---
+    sequence: list-like
+
+    :return
+    ---
+    list of unique elements.
+    """
+    # pandas hashes in C and preserves order, but only use it on arrays
+    # that are already typed. Converting lists would coerce mixed types
+    # (e.g., matplotlib colors), so those go through the set.
+    if isinstance(sequence, (np.ndarray, pd.Series)) \
+            and sequence.dtype != object and sequence.ndim == 1:
+        return list(pd.unique(sequence))
+
     seen = set()
     seen_add = seen.add
 